@@ -0,0 +1,65 @@
+from tensorflow import keras
+
+import config
+
+
+def build_augmentation():
+    """
+    Keras preprocessing layers reproducing the random transformations
+    formerly applied by the training ImageDataGenerator (after rescaling).
+    Layers compute in float32 since their outputs are also the reconstruction targets.
+    """
+    augmentation = keras.Sequential(
+        [
+            # factor is a fraction of a full turn
+            keras.layers.RandomRotation(
+                factor=config.ROT_ANGLE / 360,
+                fill_mode=config.FILL_MODE,
+                dtype="float32",
+            ),
+            keras.layers.RandomTranslation(
+                height_factor=config.H_SHIFT_RANGE,
+                width_factor=config.W_SHIFT_RANGE,
+                fill_mode=config.FILL_MODE,
+                dtype="float32",
+            ),
+            keras.layers.RandomBrightness(
+                factor=config.BRIGHTNESS_RANGE[1] - 1,
+                value_range=(0.0, 1.0),
+                dtype="float32",
+            ),
+        ],
+        name="augmentation",
+    )
+    return augmentation
+
+
+class AugmentedModel(keras.Model):
+    """
+    Wraps an autoencoder to apply data augmentation on the device during training.
+    Transformed images are used both as input and as reconstruction target,
+    like ImageDataGenerator with class_mode="input" did.
+    Training and validation images are fed unrescaled and rescaled on the device.
+    Only the wrapped autoencoder is meant to be saved and used for inference,
+    on rescaled images.
+    """
+
+    def __init__(self, autoencoder, augmentation, rescale, **kwargs):
+        super().__init__(**kwargs)
+        self.autoencoder = autoencoder
+        self.augmentation = augmentation
+        self.rescaling = keras.layers.Rescaling(rescale, dtype="float32")
+
+    def call(self, inputs, training=None):
+        return self.autoencoder(inputs, training=training)
+
+    def train_step(self, data):
+        imgs, _ = data
+        imgs = self.rescaling(imgs)
+        imgs = self.augmentation(imgs, training=True)
+        return super().train_step((imgs, imgs))
+
+    def test_step(self, data):
+        imgs, _ = data
+        imgs = self.rescaling(imgs)
+        return super().test_step((imgs, imgs))
@@ -6,12 +6,14 @@ import sys
 import os
 import shutil
 import datetime
+import math
 import json
 from pathlib import Path
 
 import tensorflow as tf
 from tensorflow import keras
 import ktrain
+from ktrain.lroptimize.triangular import CyclicLR
 
 import numpy as np
 import pandas as pd
@@ -24,6 +26,7 @@ from autoencoder.models import resnetCAE
 from autoencoder.models import skipCAE
 from autoencoder import metrics
 from autoencoder import losses
+from autoencoder.augmentation import AugmentedModel, build_augmentation
 
 import config
 import logging
@@ -51,7 +54,19 @@ class AutoEncoder:
         self.architecture = architecture
         self.color_mode = color_mode
         self.loss = loss
-        self.batch_size = batch_size
+
+        # data parallelism: each GPU processes batch_size images per step
+        # (the default strategy avoids cross-device overhead on a single device)
+        if len(tf.config.list_physical_devices("GPU")) > 1:
+            self.strategy = tf.distribute.MirroredStrategy()
+        else:
+            self.strategy = tf.distribute.get_strategy()
+        self.batch_size = batch_size * self.strategy.num_replicas_in_sync
+        logger.info(
+            "training on {} device(s) with a global batch size of {}.".format(
+                self.strategy.num_replicas_in_sync, self.batch_size
+            )
+        )
 
         # custom learning rate estimation attributes
         self.lr_opt = None
@@ -67,66 +82,76 @@ class AutoEncoder:
 
         # training attributes
         self.learner = None
+        self.train_dataset = None
+        self.validation_dataset = None
+        self.nb_train_images = None
+        self.nb_val_images = None
 
         # results attributes
         self.hist = None
         self.epochs_trained = None
 
-        # build model and preprocessing variables
-        if architecture == "mvtecCAE":
-            # Preprocessing parameters
-            self.model = mvtecCAE.build_model(color_mode)
-            self.rescale = mvtecCAE.RESCALE
-            self.shape = mvtecCAE.SHAPE
-            self.preprocessing_function = mvtecCAE.PREPROCESSING_FUNCTION
-            self.preprocessing = mvtecCAE.PREPROCESSING
-            self.vmin = mvtecCAE.VMIN
-            self.vmax = mvtecCAE.VMAX
-            self.dynamic_range = mvtecCAE.DYNAMIC_RANGE
-
-        elif architecture == "baselineCAE":
-            # Preprocessing parameters
-            self.model = baselineCAE.build_model(color_mode)
-            self.rescale = baselineCAE.RESCALE
-            self.shape = baselineCAE.SHAPE
-            self.preprocessing_function = baselineCAE.PREPROCESSING_FUNCTION
-            self.preprocessing = baselineCAE.PREPROCESSING
-            self.vmin = baselineCAE.VMIN
-            self.vmax = baselineCAE.VMAX
-            self.dynamic_range = baselineCAE.DYNAMIC_RANGE
-
-        elif architecture == "inceptionCAE":
-            # Preprocessing parameters
-            self.model = inceptionCAE.build_model(color_mode)
-            self.rescale = inceptionCAE.RESCALE
-            self.shape = inceptionCAE.SHAPE
-            self.preprocessing_function = inceptionCAE.PREPROCESSING_FUNCTION
-            self.preprocessing = inceptionCAE.PREPROCESSING
-            self.vmin = inceptionCAE.VMIN
-            self.vmax = inceptionCAE.VMAX
-            self.dynamic_range = inceptionCAE.DYNAMIC_RANGE
-
-        elif architecture == "resnetCAE":
-            # Preprocessing parameters
-            self.model = resnetCAE.build_model(color_mode)
-            self.rescale = resnetCAE.RESCALE
-            self.shape = resnetCAE.SHAPE
-            self.preprocessing_function = resnetCAE.PREPROCESSING_FUNCTION
-            self.preprocessing = resnetCAE.PREPROCESSING
-            self.vmin = resnetCAE.VMIN
-            self.vmax = resnetCAE.VMAX
-            self.dynamic_range = resnetCAE.DYNAMIC_RANGE
-
-        elif architecture == "skipCAE":
-            # Preprocessing parameters
-            self.model = skipCAE.build_model(color_mode)
-            self.rescale = skipCAE.RESCALE
-            self.shape = skipCAE.SHAPE
-            self.preprocessing_function = skipCAE.PREPROCESSING_FUNCTION
-            self.preprocessing = skipCAE.PREPROCESSING
-            self.vmin = skipCAE.VMIN
-            self.vmax = skipCAE.VMAX
-            self.dynamic_range = skipCAE.DYNAMIC_RANGE
+        # build model and preprocessing variables (replicated on all GPUs)
+        with self.strategy.scope():
+            if architecture == "mvtecCAE":
+                # Preprocessing parameters
+                self.build_model = mvtecCAE.build_model
+                self.model = self.build_model(color_mode)
+                self.rescale = mvtecCAE.RESCALE
+                self.shape = mvtecCAE.SHAPE
+                self.preprocessing_function = mvtecCAE.PREPROCESSING_FUNCTION
+                self.preprocessing = mvtecCAE.PREPROCESSING
+                self.vmin = mvtecCAE.VMIN
+                self.vmax = mvtecCAE.VMAX
+                self.dynamic_range = mvtecCAE.DYNAMIC_RANGE
+
+            elif architecture == "baselineCAE":
+                # Preprocessing parameters
+                self.build_model = baselineCAE.build_model
+                self.model = self.build_model(color_mode)
+                self.rescale = baselineCAE.RESCALE
+                self.shape = baselineCAE.SHAPE
+                self.preprocessing_function = baselineCAE.PREPROCESSING_FUNCTION
+                self.preprocessing = baselineCAE.PREPROCESSING
+                self.vmin = baselineCAE.VMIN
+                self.vmax = baselineCAE.VMAX
+                self.dynamic_range = baselineCAE.DYNAMIC_RANGE
+
+            elif architecture == "inceptionCAE":
+                # Preprocessing parameters
+                self.build_model = inceptionCAE.build_model
+                self.model = self.build_model(color_mode)
+                self.rescale = inceptionCAE.RESCALE
+                self.shape = inceptionCAE.SHAPE
+                self.preprocessing_function = inceptionCAE.PREPROCESSING_FUNCTION
+                self.preprocessing = inceptionCAE.PREPROCESSING
+                self.vmin = inceptionCAE.VMIN
+                self.vmax = inceptionCAE.VMAX
+                self.dynamic_range = inceptionCAE.DYNAMIC_RANGE
+
+            elif architecture == "resnetCAE":
+                # Preprocessing parameters
+                self.build_model = resnetCAE.build_model
+                self.model = self.build_model(color_mode)
+                self.rescale = resnetCAE.RESCALE
+                self.shape = resnetCAE.SHAPE
+                self.preprocessing_function = resnetCAE.PREPROCESSING_FUNCTION
+                self.preprocessing = resnetCAE.PREPROCESSING
+                self.vmin = resnetCAE.VMIN
+                self.vmax = resnetCAE.VMAX
+                self.dynamic_range = resnetCAE.DYNAMIC_RANGE
+
+            elif architecture == "skipCAE":
+                # Preprocessing parameters
+                self.build_model = skipCAE.build_model
+                self.model = self.build_model(color_mode)
+                self.rescale = skipCAE.RESCALE
+                self.shape = skipCAE.SHAPE
+                self.preprocessing_function = skipCAE.PREPROCESSING_FUNCTION
+                self.preprocessing = skipCAE.PREPROCESSING
+                self.vmin = skipCAE.VMIN
+                self.vmax = skipCAE.VMAX
+                self.dynamic_range = skipCAE.DYNAMIC_RANGE
 
         # Learning Rate Finder parameters
         self.start_lr = config.START_LR
@@ -134,6 +159,7 @@ class AutoEncoder:
         self.lrf_decrease_factor = config.LRF_DECREASE_FACTOR
 
         # Training parameters
+        self.max_epochs = max(1, config.MAX_EPOCHS)
         self.early_stopping = config.EARLY_STOPPING
         self.reduce_on_plateau = config.REDUCE_ON_PLATEAU
 
@@ -161,20 +187,42 @@ class AutoEncoder:
         # create directory to save model and logs
         self.create_save_dir()
 
-        # compile model
-        self.model.compile(
-            loss=self.loss_function, optimizer="adam", metrics=self.metrics
-        )
+        with self.strategy.scope():
+            # wrap model to perform data augmentation on the device during training
+            self.trainer = AugmentedModel(
+                self.model, build_augmentation(), self.rescale
+            )
+            self.trainer.build(self.model.input_shape)
+
+            # compile model (the saved autoencoder shares the trainer's optimizer)
+            optimizer = keras.optimizers.Adam()
+            if keras.mixed_precision.global_policy().name == "mixed_float16":
+                # scale loss to prevent float16 gradients from underflowing
+                optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+            self.model.compile(
+                loss=self.loss_function, optimizer=optimizer, metrics=self.metrics
+            )
+            self.trainer.compile(
+                loss=self.loss_function, optimizer=optimizer, metrics=self.metrics
+            )
         return
 
     ### Methods for training =================================================
 
-    def find_lr_opt(self, train_generator, validation_generator):
+    def find_lr_opt(
+        self, train_dataset, validation_dataset, nb_train_images, nb_val_images
+    ):
+        self.train_dataset = train_dataset
+        self.validation_dataset = validation_dataset
+        self.nb_train_images = nb_train_images
+        self.nb_val_images = nb_val_images
+
         # initialize learner object
+        # (tf.data.Dataset does not know its size, hence the wrapping)
         self.learner = ktrain.get_learner(
-            model=self.model,
-            train_data=train_generator,
-            val_data=validation_generator,
+            model=self.trainer,
+            train_data=ktrain.TFDataset(train_dataset, n=nb_train_images, y=None),
+            val_data=ktrain.TFDataset(validation_dataset, n=nb_val_images, y=None),
             batch_size=self.batch_size,
         )
 
@@ -249,23 +297,46 @@ class AutoEncoder:
             "run the following command in a seperate terminal to monitor training on tensorboard:"
             + "\ntensorboard --logdir={}\n".format(self.log_dir)
         )
-        assert self.learner.model is self.model
 
-        # fit model using Cyclical Learning Rates
-        self.hist = self.learner.autofit(
-            lr=lr_opt,
-            epochs=None,
-            early_stopping=self.early_stopping,
+        # training batches all have the same shape (see get_train_dataset),
+        # hence a fixed number of full batches per epoch
+        steps_per_epoch = max(1, self.nb_train_images // self.batch_size)
+
+        # triangular Cyclical Learning Rate policy (one cycle per epoch)
+        # with cyclical momentum and learning rate reduction on plateau
+        clr_cb = CyclicLR(
+            base_lr=lr_opt / 10,
+            max_lr=lr_opt,
+            step_size=math.ceil(steps_per_epoch / 2),
             reduce_on_plateau=self.reduce_on_plateau,
+            monitor="val_loss",
             reduce_factor=2,
-            cycle_momentum=True,
             max_momentum=0.95,
             min_momentum=0.85,
+            verbose=self.verbose,
+        )
+        # stop training when validation loss stops improving
+        early_stopping_cb = keras.callbacks.EarlyStopping(
             monitor="val_loss",
-            checkpoint_folder=None,
+            min_delta=0,
+            patience=self.early_stopping,
+            restore_best_weights=True,
+            verbose=1,
+        )
+
+        # fit model using Cyclical Learning Rates
+        logger.info("begin training using triangular learning rate policy...")
+        self.hist = self.trainer.fit(
+            self.train_dataset,
+            epochs=self.max_epochs,
+            steps_per_epoch=steps_per_epoch,
+            validation_data=self.validation_dataset,
+            callbacks=[clr_cb, early_stopping_cb, tensorboard_cb],
             verbose=self.verbose,
-            callbacks=[tensorboard_cb],
         )
+        self.hist.history["lr"] = clr_cb.history["lr"]
+        self.hist.history["iterations"] = clr_cb.history["iterations"]
+        self.hist.history["momentum"] = clr_cb.history["momentum"]
         return
 
     ### Methods to create directory structure and save (and load?) model =================
@@ -291,6 +362,27 @@ class AutoEncoder:
         self.log_dir = log_dir
         return
 
+    def get_float32_model(self):
+        """
+        Returns the trained model, or a float32 copy of it if it was trained
+        under mixed precision, so that the saved model runs in float32 on any device.
+        """
+        policy = keras.mixed_precision.global_policy()
+        if policy.name == "float32":
+            return self.model
+        keras.mixed_precision.set_global_policy("float32")
+        try:
+            model = self.build_model(self.color_mode)
+        finally:
+            keras.mixed_precision.set_global_policy(policy)
+        model.set_weights(self.model.get_weights())
+        model.compile(
+            loss=self.loss_function,
+            optimizer=keras.optimizers.Adam(),
+            metrics=self.metrics,
+        )
+        return model
+
     def create_model_name(self):
         epochs_trained = self.get_best_epoch()
         model_name = self.architecture + "_b{}_e{}.hdf5".format(
@@ -300,7 +392,8 @@ class AutoEncoder:
 
     def save(self):
         # save model
-        self.model.save(os.path.join(self.save_dir, self.create_model_name()))
+        model = self.get_float32_model()
+        model.save(os.path.join(self.save_dir, self.create_model_name()))
         # save trainnig info
         info = self.get_info()
         with open(os.path.join(self.save_dir, "info.json"), "w") as json_file:
@@ -330,9 +423,9 @@ class AutoEncoder:
         info = {
             "data": {
                 "input_directory": self.input_directory,
-                "nb_training_images": self.learner.train_data.samples,
-                "nb_validation_images": self.learner.val_data.samples,
-                "validation_split": self.learner.train_data.image_data_generator._validation_split,
+                "nb_training_images": self.nb_train_images,
+                "nb_validation_images": self.nb_val_images,
+                "validation_split": config.VAL_SPLIT,
             },
             "model": {"architecture": self.architecture, "loss": self.loss,},
             "preprocessing": {
@@ -374,7 +467,7 @@ class AutoEncoder:
 
     def get_total_nb_training_images(self):
         epochs_trained = self.get_best_epoch()
-        total_nb = int(epochs_trained * self.learner.train_data.samples)
+        total_nb = int(epochs_trained * self.nb_train_images)
         return total_nb
 
     ### Methods for plotting ============================================
@@ -441,8 +534,10 @@ class AutoEncoder:
 
     def lr_schedule_plot(self, save=False):
         with plt.style.context("seaborn-darkgrid"):
-            fig, _ = plt.subplots()
-            self.learner.plot(plot_type="lr")
+            fig, ax = plt.subplots()
+            ax.plot(self.hist.history["lr"])
+            plt.ylabel("learning rate")
+            plt.xlabel("iterations")
             plt.title("Cyclical Learning Rate Scheduler")
             plt.show()
         if save:
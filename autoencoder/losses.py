@@ -1,12 +1,74 @@
 import tensorflow as tf
 
+# SSIM parameters (same defaults as tf.image.ssim and tf.image.ssim_multiscale)
+FILTER_SIZE = 11
+FILTER_SIGMA = 1.5
+K1 = 0.01
+K2 = 0.03
+MSSIM_POWER_FACTORS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+# numerical stabilizer against NaN gradients in MSSIM
+EPSILON = 1e-8
+
+
+def fspecial_gauss(size, sigma, channels=1):
+    """
+    Returns a normalized 2D gaussian window of shape (size x size x channels x 1),
+    usable as a depthwise convolution filter.
+    """
+    coords = tf.range(size, dtype=tf.float32) - (size - 1) / 2
+    g = tf.exp(-(coords ** 2) / (2 * sigma ** 2))
+    g = g / tf.reduce_sum(g)
+    window = g[:, None] * g[None, :]
+    return tf.tile(window[:, :, None, None], [1, 1, channels, 1])
+
+
+def _ssim_per_channel(imgs_true, imgs_pred, window, dynamic_range):
+    """
+    Returns SSIM and contrast-structure of each channel of each image,
+    computed as in tf.image.ssim but with a precomputed gaussian window.
+    """
+    # fold channels into the batch so that the single channel window fits any input
+    shape = tf.shape(imgs_true)
+    folded_shape = [-1, shape[1], shape[2], 1]
+    imgs_true = tf.reshape(tf.transpose(imgs_true, [0, 3, 1, 2]), folded_shape)
+    imgs_pred = tf.reshape(tf.transpose(imgs_pred, [0, 3, 1, 2]), folded_shape)
+
+    def filter_fn(x):
+        return tf.nn.conv2d(x, window, strides=1, padding="VALID")
+
+    c1 = (K1 * dynamic_range) ** 2
+    c2 = (K2 * dynamic_range) ** 2
+
+    mu_true = filter_fn(imgs_true)
+    mu_pred = filter_fn(imgs_pred)
+    mu_true_sq = mu_true * mu_true
+    mu_pred_sq = mu_pred * mu_pred
+    mu_true_pred = mu_true * mu_pred
+    # variances can come out slightly negative on flat regions due to rounding
+    sigma_true_sq = tf.maximum(filter_fn(imgs_true * imgs_true) - mu_true_sq, 0.0)
+    sigma_pred_sq = tf.maximum(filter_fn(imgs_pred * imgs_pred) - mu_pred_sq, 0.0)
+    sigma_true_pred = filter_fn(imgs_true * imgs_pred) - mu_true_pred
+
+    luminance = (2 * mu_true_pred + c1) / (mu_true_sq + mu_pred_sq + c1)
+    cs = (2 * sigma_true_pred + c2) / (sigma_true_sq + sigma_pred_sq + c2)
+
+    # unfold channels: (samples x channels)
+    ssim = tf.reduce_mean(luminance * cs, axis=[1, 2, 3])
+    ssim = tf.reshape(ssim, [shape[0], shape[3]])
+    cs = tf.reshape(tf.reduce_mean(cs, axis=[1, 2, 3]), [shape[0], shape[3]])
+    return ssim, cs
+
 
 def ssim_loss(dynamic_range):
+    # gaussian window is built once, not at every training step
+    window = fspecial_gauss(FILTER_SIZE, FILTER_SIGMA)
+
     def loss(imgs_true, imgs_pred):
 
         # return (1 - tf.image.ssim(imgs_true, imgs_pred, dynamic_range)) / 2
 
-        return 1 - tf.image.ssim(imgs_true, imgs_pred, dynamic_range)
+        ssim, _ = _ssim_per_channel(imgs_true, imgs_pred, window, dynamic_range)
+        return 1 - tf.reduce_mean(ssim, axis=-1)
 
         # return 1 - tf.reduce_mean(tf.image.ssim(y_true, y_pred, dynamic_range))
 
@@ -14,9 +76,24 @@ def ssim_loss(dynamic_range):
 
 
 def mssim_loss(dynamic_range):
+    # gaussian window is built once, not at every training step
+    window = fspecial_gauss(FILTER_SIZE, FILTER_SIGMA)
+
     def loss(imgs_true, imgs_pred):
 
-        return 1 - tf.image.ssim_multiscale(imgs_true, imgs_pred, dynamic_range)
+        mcs = []
+        for scale in range(len(MSSIM_POWER_FACTORS)):
+            if scale > 0:
+                imgs_true = tf.nn.avg_pool2d(imgs_true, 2, strides=2, padding="SAME")
+                imgs_pred = tf.nn.avg_pool2d(imgs_pred, 2, strides=2, padding="SAME")
+            ssim, cs = _ssim_per_channel(imgs_true, imgs_pred, window, dynamic_range)
+            mcs.append(tf.nn.relu(cs))
+        # contrast-structure at all but the coarsest scale, SSIM at the coarsest
+        mcs_and_ssim = tf.stack(mcs[:-1] + [tf.nn.relu(ssim)], axis=-1)
+        # x ** p has an infinite gradient at x = 0 for p < 1
+        mcs_and_ssim = mcs_and_ssim + EPSILON
+        mssim = tf.reduce_prod(mcs_and_ssim ** MSSIM_POWER_FACTORS, axis=-1)
+        return 1 - tf.reduce_mean(mssim, axis=-1)
 
         # return 1 - tf.reduce_mean(
         #     tf.image.ssim_multiscale(imgs_true, imgs_pred, dynamic_range)
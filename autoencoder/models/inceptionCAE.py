@@ -131,7 +131,8 @@ def build_model(color_mode, filters=[32, 64, 128]):
         img_dim[2], (3, 3), padding="same", kernel_regularizer=regularizers.l2(1e-6)
     )(x)
     x = BatchNormalization()(x)
-    x = Activation("sigmoid")(x)
+    # keep output in float32 under mixed precision
+    x = Activation("sigmoid", dtype="float32")(x)
 
     decoded = x
     # model
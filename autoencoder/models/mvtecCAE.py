@@ -64,8 +64,9 @@ def build_model(color_mode):
     x = keras.layers.Conv2D(32, (8, 8), activation="relu", padding="same")(x)
 
     x = keras.layers.UpSampling2D((2, 2))(x)
+    # keep output in float32 under mixed precision
     decoded = keras.layers.Conv2D(
-        channels, (8, 8), activation="sigmoid", padding="same"
+        channels, (8, 8), activation="sigmoid", padding="same", dtype="float32"
     )(x)
 
     model = keras.models.Model(input_img, decoded)
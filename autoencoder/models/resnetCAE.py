@@ -89,8 +89,14 @@ def build_model(color_mode):
     ####
     add_4 = Add()([layer_19, layer_24])
     ####
+    # keep output in float32 under mixed precision
     decoded = Conv2DTranspose(
-        channels, kernel_size=4, strides=2, padding="same", activation="sigmoid",
+        channels,
+        kernel_size=4,
+        strides=2,
+        padding="same",
+        activation="sigmoid",
+        dtype="float32",
     )(add_4)
 
     model = Model(resnet.input, decoded)
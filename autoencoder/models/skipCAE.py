@@ -100,8 +100,14 @@ def build_model(color_mode):
     y = LeakyReLU()(y)
     # # ----------------------------------------------------------------------
 
+    # keep output in float32 under mixed precision
     y = Conv2DTranspose(
-        img_dim[2], (3, 3), activation="sigmoid", padding="same", strides=(2, 2)
+        img_dim[2],
+        (3, 3),
+        activation="sigmoid",
+        padding="same",
+        strides=(2, 2),
+        dtype="float32",
     )(y)
 
     # model
@@ -6,14 +6,25 @@ FILL_MODE = "nearest"
 BRIGHTNESS_RANGE = [0.95, 1.05]
 VAL_SPLIT = 0.1
 
+# Input pipeline parameters
+# decoded images are cached in RAM, set a directory (e.g. on a local SSD)
+# to cache them on disk instead when they do not fit in memory
+CACHE_DIR = None
+# set a writable directory to save decoded images there on the first run
+# and skip decoding on following runs (e.g. for parallel hyperparameter sweeps)
+SNAPSHOT_DIR = None
+
 # Learning Rate Finder parameters
 START_LR = 1e-5
 LR_MAX_EPOCHS = 10
 LRF_DECREASE_FACTOR = 0.85
 
 # Training parameters
+MAX_EPOCHS = 1024  # upper bound, training is ended by early stopping
 EARLY_STOPPING = 12
 REDUCE_ON_PLATEAU = 6
+MIXED_PRECISION = True  # only applied when a GPU is available
+XLA = True  # fuse compatible ops with XLA auto-clustering
 
 # Finetuning parameters
 FINETUNE_SPLIT = 0.1
@@ -73,6 +73,7 @@ def main(args):
     vmin = info["preprocessing"]["vmin"]
     vmax = info["preprocessing"]["vmax"]
     nb_validation_images = info["data"]["nb_validation_images"]
+    batch_size = info["training"]["batch_size"]
 
     # get the correct preprocessing function
     preprocessing_function = get_preprocessing_function(architecture)
@@ -90,19 +91,19 @@ def main(args):
 
     # -------------------------------------------------------------------
 
-    # get validation generator
-    validation_generator = preprocessor.get_val_generator(
+    # get validation dataset
+    validation_dataset = preprocessor.get_val_dataset(
         batch_size=nb_validation_images, shuffle=False
     )
 
-    # retrieve preprocessed validation images from generator
-    imgs_val_input = validation_generator.next()[0]
+    # retrieve preprocessed validation images from dataset
+    imgs_val_input = next(iter(validation_dataset))[0].numpy()
 
     # retrieve validation image_names
-    filenames_val = validation_generator.filenames
+    filenames_val = preprocessor.get_filenames(subset="validation")
 
     # reconstruct (i.e predict) validation images
-    imgs_val_pred = model.predict(imgs_val_input)
+    imgs_val_pred = utils.predict_images(model, imgs_val_input, batch_size)
 
     # instantiate TensorImages object to compute validation resmaps
     tensor_val = postprocessing.TensorImages(
@@ -152,7 +153,7 @@ def main(args):
     filenames_ft = list(np.array(filenames_test)[index_array_ft])
 
     # reconstruct (i.e predict) finetuning images
-    imgs_ft_pred = model.predict(imgs_ft_input)
+    imgs_ft_pred = utils.predict_images(model, imgs_ft_input, batch_size)
 
     # instantiate TensorImages object to compute finetuning resmaps
     tensor_ft = postprocessing.TensorImages(
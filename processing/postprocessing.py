@@ -3,8 +3,8 @@ import time
 import numpy as np
 import tensorflow as tf
 from processing.utils import printProgressBar
+from autoencoder.losses import fspecial_gauss
 import matplotlib.pyplot as plt
-from skimage.metrics import structural_similarity
 from skimage.segmentation import clear_border
 from skimage.measure import label, regionprops
 from skimage.morphology import closing, square
@@ -28,6 +28,14 @@ THRESH_STEP_UINT8_SSIM = 1
 THRESH_MIN_UINT8_L2 = 5
 THRESH_STEP_UINT8_L2 = 1
 
+# SSIM Parameters (same as skimage's structural_similarity with gaussian weights)
+SSIM_WIN_SIZE = 11
+SSIM_SIGMA = 1.5
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+# skimage's default data range for float images, i.e. dmax - dmin = 1 - (-1)
+SSIM_DATA_RANGE = 2.0
+
 
 class TensorImages:
     def __init__(
@@ -194,46 +202,88 @@ def get_plot_name(filename, suffix):
 
 def calculate_resmaps(imgs_input, imgs_pred, method, dtype="float64"):
     """
-    To calculate resmaps, input tensors must be grayscale and of shape (samples x length x width).
+    Input tensors must be either grayscale of shape (samples x length x width)
+    or RGB of shape (samples x length x width x 3). Resmaps are computed on grayscale
+    images and are of shape (samples x length x width).
     """
-    # if RGB, transform to grayscale and reduce tensor dimension to 3
-    if imgs_input.ndim == 4 and imgs_input.shape[-1] == 3:
-        imgs_input_gray = tf.image.rgb_to_grayscale(imgs_input).numpy()[:, :, :, 0]
-        imgs_pred_gray = tf.image.rgb_to_grayscale(imgs_pred).numpy()[:, :, :, 0]
-    else:
-        imgs_input_gray = imgs_input
-        imgs_pred_gray = imgs_pred
-
     # calculate remaps
     if method == "l2":
-        scores, resmaps = resmaps_l2(imgs_input_gray, imgs_pred_gray)
+        # if RGB, transform to grayscale and reduce tensor dimension to 3
+        if imgs_input.ndim == 4 and imgs_input.shape[-1] == 3:
+            imgs_input = tf.image.rgb_to_grayscale(imgs_input).numpy()[:, :, :, 0]
+            imgs_pred = tf.image.rgb_to_grayscale(imgs_pred).numpy()[:, :, :, 0]
+        scores, resmaps = resmaps_l2(imgs_input, imgs_pred)
     elif method in ["ssim", "mssim"]:
-        scores, resmaps = resmaps_ssim(imgs_input_gray, imgs_pred_gray)
+        # grayscale conversion, if RGB, happens within the SSIM graph
+        scores, resmaps = resmaps_ssim(imgs_input, imgs_pred)
     if dtype == "uint8":
         resmaps = img_as_ubyte(resmaps)
     return scores, resmaps
 
 
-def resmaps_ssim(imgs_input, imgs_pred):
-    resmaps = np.zeros(shape=imgs_input.shape, dtype="float64")
-    scores = []
-    for index in range(len(imgs_input)):
-        img_input = imgs_input[index]
-        img_pred = imgs_pred[index]
-        score, resmap = structural_similarity(
-            img_input,
-            img_pred,
-            win_size=11,
-            gaussian_weights=True,
-            multichannel=False,
-            sigma=1.5,
-            full=True,
+@tf.function
+def ssim_maps(imgs_input, imgs_pred):
+    """
+    Computes the SSIM maps and mean SSIM scores of a whole batch of images
+    of shape (samples x length x width x channels) in a single graph.
+    RGB images are converted to grayscale first, maps are single channel.
+    Reproduces skimage.metrics.structural_similarity(
+    win_size=11, gaussian_weights=True, sigma=1.5, full=True) applied image per image.
+    """
+    if imgs_input.shape[-1] == 3:
+        imgs_input = tf.image.rgb_to_grayscale(imgs_input)
+        imgs_pred = tf.image.rgb_to_grayscale(imgs_pred)
+
+    # resmaps are computed on grayscale images, hence a single channel window
+    # (built at trace time, not on import)
+    window = fspecial_gauss(SSIM_WIN_SIZE, SSIM_SIGMA, channels=1)
+    pad = (SSIM_WIN_SIZE - 1) // 2
+    paddings = [[0, 0], [pad, pad], [pad, pad], [0, 0]]
+
+    def filter_fn(x):
+        # same border handling as scipy.ndimage.gaussian_filter (mode="reflect")
+        x = tf.pad(x, paddings, mode="SYMMETRIC")
+        return tf.nn.depthwise_conv2d(
+            x, window, strides=[1, 1, 1, 1], padding="VALID"
         )
-        # resmap = np.expand_dims(resmap, axis=-1)
-        resmaps[index] = 1 - resmap
-        scores.append(score)
+
+    # sample covariance normalization
+    np_ = SSIM_WIN_SIZE ** 2
+    cov_norm = np_ / (np_ - 1)
+
+    ux = filter_fn(imgs_input)
+    uy = filter_fn(imgs_pred)
+    uxx = filter_fn(imgs_input * imgs_input)
+    uyy = filter_fn(imgs_pred * imgs_pred)
+    uxy = filter_fn(imgs_input * imgs_pred)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    c1 = (SSIM_K1 * SSIM_DATA_RANGE) ** 2
+    c2 = (SSIM_K2 * SSIM_DATA_RANGE) ** 2
+    a1 = 2 * ux * uy + c1
+    a2 = 2 * vxy + c2
+    b1 = ux ** 2 + uy ** 2 + c1
+    b2 = vx + vy + c2
+    maps = (a1 * a2) / (b1 * b2)
+
+    # mean SSIM is computed without the borders
+    scores = tf.reduce_mean(maps[:, pad:-pad, pad:-pad, :], axis=[1, 2, 3])
+    return scores, maps
+
+
+def resmaps_ssim(imgs_input, imgs_pred):
+    # grayscale images of shape (samples x length x width) need a channel axis
+    if imgs_input.ndim == 3:
+        imgs_input = imgs_input[..., np.newaxis]
+        imgs_pred = imgs_pred[..., np.newaxis]
+    imgs_input = tf.convert_to_tensor(imgs_input, dtype=tf.float32)
+    imgs_pred = tf.convert_to_tensor(imgs_pred, dtype=tf.float32)
+    scores, maps = ssim_maps(imgs_input, imgs_pred)
+    resmaps = 1 - maps.numpy()[..., 0].astype("float64")
     resmaps = np.clip(resmaps, a_min=-1, a_max=1)
-    return scores, resmaps
+    return list(scores.numpy()), resmaps
 
 
 def resmaps_l2(imgs_input, imgs_pred):
@@ -1,6 +1,20 @@
 import os
+import shutil
+import hashlib
+import tempfile
+import tensorflow as tf
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
+from tensorflow.keras.preprocessing.image import load_img, img_to_array
 import config
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# same extensions as those accepted by ImageDataGenerator.flow_from_directory()
+WHITE_LIST_FORMATS = (".png", ".jpg", ".jpeg", ".bmp", ".ppm", ".tif", ".tiff")
 
 
 class Preprocessor:
@@ -16,73 +30,69 @@ class Preprocessor:
         self.preprocessing_function = preprocessing_function
         self.validation_split = config.VAL_SPLIT
 
+        self.nb_train_images = None
         self.nb_val_images = None
         self.nb_test_images = None
 
-    def get_train_generator(self, batch_size, shuffle=True):
-        # This will do preprocessing and realtime data augmentation:
-        train_datagen = ImageDataGenerator(
-            # standarize input
-            featurewise_center=False,
-            featurewise_std_normalization=False,
-            # randomly rotate images in the range (degrees, 0 to 180)
-            rotation_range=config.ROT_ANGLE,
-            # randomly shift images horizontally (fraction of total width)
-            width_shift_range=config.W_SHIFT_RANGE,
-            # randomly shift images vertically (fraction of total height)
-            height_shift_range=config.H_SHIFT_RANGE,
-            # set mode for filling points outside the input boundaries
-            fill_mode=config.FILL_MODE,
-            # value used for fill_mode = "constant"
-            cval=0.0,
-            # randomly change brightness (darker < 1 < brighter)
-            brightness_range=config.BRIGHTNESS_RANGE,
-            # set rescaling factor (applied before any other transformation)
-            rescale=self.rescale,
-            # set function that will be applied on each input
-            preprocessing_function=self.preprocessing_function,
-            # image data format, either "channels_first" or "channels_last"
-            data_format="channels_last",
-            # fraction of images reserved for validation (strictly between 0 and 1)
-            validation_split=self.validation_split,
-        )
+        # (class_name, sorted image filenames) pairs of train_data_dir
+        self.class_filenames = None
+        # decoded and cached datasets, one per subset
+        self.decoded_datasets = {}
 
-        # Generate training batches with datagen.flow_from_directory()
-        train_generator = train_datagen.flow_from_directory(
-            directory=self.train_data_dir,
-            target_size=self.shape,
-            color_mode=self.color_mode,
-            batch_size=batch_size,
-            class_mode="input",
-            subset="training",
-            shuffle=True,
+        if color_mode == "grayscale":
+            self.channels = 1
+        elif color_mode == "rgb":
+            self.channels = 3
+
+    def get_train_dataset(self, batch_size, shuffle=True, rescale=True):
+        """
+        Yields batches of (input, target) training images, target = input.
+        Images are at most rescaled here, random transformations are applied
+        on the device during the training step (see autoencoder.augmentation).
+        Pass rescale=False to leave rescaling to the device as well.
+        Batches have a fixed shape and the dataset repeats indefinitely,
+        epochs are delimited by steps_per_epoch in AutoEncoder.fit().
+        """
+        self.nb_train_images = len(self.get_filenames(subset="training"))
+        dataset = self.get_decoded_dataset(subset="training", deterministic=not shuffle)
+        if shuffle:
+            dataset = dataset.shuffle(
+                self.nb_train_images, reshuffle_each_iteration=True
+            )
+        dataset = self.to_input_target(dataset, rescale)
+        # drop the last incomplete batch so that the training step is traced once,
+        # unless there are not enough images for a single full batch
+        dataset = dataset.batch(
+            batch_size, drop_remainder=self.nb_train_images >= batch_size
         )
-        return train_generator
+        dataset = dataset.repeat().prefetch(AUTOTUNE)
+        return dataset
 
-    def get_val_generator(self, batch_size, shuffle=True):
+    def get_val_dataset(self, batch_size, shuffle=True, rescale=True):
         """
+        Yields batches of (input, target) validation images, target = input.
+        For validation dataset, only rescaling, unless rescale=False.
         For training, pass autoencoder.batch_size as batch size.
-        For validation, pass nb_validation_images as batch size.
-        For test, pass nb_test_images as batch size.
+        For inspection, pass nb_val_images as batch size and shuffle=False:
+        images are then yielded in the order of get_filenames("validation").
         """
-        # For validation dataset, only rescaling
-        validation_datagen = ImageDataGenerator(
-            rescale=self.rescale,
-            data_format="channels_last",
-            validation_split=self.validation_split,
-            preprocessing_function=self.preprocessing_function,
-        )
-        # Generate validation batches with datagen.flow_from_directory()
-        validation_generator = validation_datagen.flow_from_directory(
-            directory=self.train_data_dir,
-            target_size=self.shape,
-            color_mode=self.color_mode,
-            batch_size=batch_size,
-            class_mode="input",
-            subset="validation",
-            shuffle=shuffle,
-        )
-        return validation_generator
+        self.nb_val_images = len(self.get_filenames(subset="validation"))
+        # always decoded in order, so that the images cached while training
+        # are reused as is for inspection
+        dataset = self.get_decoded_dataset(subset="validation", deterministic=True)
+        if shuffle:
+            dataset = dataset.shuffle(self.nb_val_images, reshuffle_each_iteration=True)
+        dataset = self.to_input_target(dataset, rescale)
+        dataset = dataset.batch(batch_size).prefetch(AUTOTUNE)
+        return dataset
+
+    def to_input_target(self, dataset, rescale=True):
+        if rescale:
+            return dataset.map(
+                lambda img: (img * self.rescale, img * self.rescale),
+                num_parallel_calls=AUTOTUNE,
+            )
+        return dataset.map(lambda img: (img, img), num_parallel_calls=AUTOTUNE)
 
     def get_test_generator(self, batch_size, shuffle=False):
         """
@@ -132,6 +142,149 @@ class Preprocessor:
         )
         return finetuning_generator
 
+    def get_filenames(self, subset):
+        """
+        Returns the sorted image paths (relative to train_data_dir) of the given subset,
+        split per class exactly like ImageDataGenerator(validation_split=...) does,
+        so that tf.data pipelines and generators see the same training
+        and validation images.
+        """
+        assert subset in ["training", "validation"]
+        # train_data_dir is only scanned once, on first call
+        if self.class_filenames is None:
+            self.class_filenames = list_class_filenames(self.train_data_dir)
+        filenames = []
+        for class_name, class_filenames in self.class_filenames:
+            split_i = int(self.validation_split * len(class_filenames))
+            if subset == "validation":
+                class_filenames = class_filenames[:split_i]
+            else:
+                class_filenames = class_filenames[split_i:]
+            filenames.extend(
+                os.path.join(class_name, fname) for fname in class_filenames
+            )
+        return filenames
+
+    def get_decoded_dataset(self, subset, deterministic=True):
+        """
+        Yields the decoded images of the given subset, before rescaling,
+        in the order of get_filenames(subset) if deterministic on first call.
+        If config.SNAPSHOT_DIR is set, decoded images are saved there on the first run
+        and loaded from there on following runs.
+        The cached dataset is built once per subset and shared by all callers.
+        """
+        if subset not in self.decoded_datasets:
+            self.decoded_datasets[subset] = self.build_decoded_dataset(
+                subset, deterministic
+            )
+        return self.decoded_datasets[subset]
+
+    def build_decoded_dataset(self, subset, deterministic=True):
+        if config.SNAPSHOT_DIR is None:
+            dataset = self.decode_images(subset, deterministic)
+            return self.cache(dataset, subset)
+
+        snapshot_dir = os.path.join(config.SNAPSHOT_DIR, self.get_dataset_name(subset))
+        nb_images = len(self.get_filenames(subset))
+        if os.path.isdir(snapshot_dir):
+            dataset = tf.data.Dataset.load(snapshot_dir)
+            if dataset.cardinality().numpy() == nb_images:
+                return self.cache(dataset, subset)
+            logger.warning("discarding stale snapshot {}".format(snapshot_dir))
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+        logger.info("saving decoded {} images to {}".format(subset, snapshot_dir))
+        if not os.path.isdir(config.SNAPSHOT_DIR):
+            os.makedirs(config.SNAPSHOT_DIR, exist_ok=True)
+        # save to a temporary directory of this run first, so that neither
+        # an interrupted run nor a concurrent one leaves an incomplete snapshot
+        tmp_dir = tempfile.mkdtemp(dir=config.SNAPSHOT_DIR)
+        try:
+            # a single shard is read back in order whatever the number of CPUs,
+            # so that images keep matching get_filenames(subset)
+            self.decode_images(subset, deterministic=True).save(
+                tmp_dir, shard_func=lambda img: tf.constant(0, dtype=tf.int64)
+            )
+            os.rename(tmp_dir, snapshot_dir)
+        except OSError:
+            # another run saved the same snapshot in the meantime
+            if not os.path.isdir(snapshot_dir):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        dataset = tf.data.Dataset.load(snapshot_dir)
+        return self.cache(dataset, subset)
+
+    def decode_images(self, subset, deterministic=True):
+        filenames = self.get_filenames(subset)
+        paths = [os.path.join(self.train_data_dir, fname) for fname in filenames]
+        dataset = tf.data.Dataset.from_tensor_slices(paths)
+        # read and decode files concurrently, order only matters when deterministic
+        dataset = dataset.interleave(
+            lambda path: tf.data.Dataset.from_tensors(self.load_image(path)),
+            num_parallel_calls=AUTOTUNE,
+            deterministic=deterministic,
+        )
+        return dataset
+
+    def get_dataset_name(self, subset):
+        # decoded images depend on the dataset, the subset, the validation split,
+        # the exact set of image files and the preprocessing
+        dir_names = os.path.normpath(self.input_directory).split(os.sep)
+        filenames_hash = hashlib.md5(
+            "\n".join(self.get_filenames(subset)).encode("utf-8")
+        ).hexdigest()[:12]
+        return "_".join(
+            [
+                *[dir_name for dir_name in dir_names if dir_name],
+                subset,
+                "split{}".format(self.validation_split),
+                filenames_hash,
+                self.color_mode,
+                "x".join(str(dim) for dim in self.shape),
+                # images are decoded with PIL and stored before rescaling
+                "pil",
+                "raw",
+            ]
+        )
+
+    def cache(self, dataset, subset):
+        """
+        Caches decoded images so that they are read and decoded only once per run,
+        in memory or on disk if config.CACHE_DIR is set.
+        Cache files are named by get_dataset_name(), so that they are not reused
+        after a change of validation split or of image files.
+        """
+        if config.CACHE_DIR is None:
+            return dataset.cache()
+        if not os.path.isdir(config.CACHE_DIR):
+            os.makedirs(config.CACHE_DIR)
+        cache_path = os.path.join(config.CACHE_DIR, self.get_dataset_name(subset))
+        return dataset.cache(cache_path)
+
+    def load_image(self, path):
+        """
+        Reads, decodes and resizes a single image file as a float32 tensor.
+        Rescaling is applied afterwards, see to_input_target().
+        """
+        img = tf.numpy_function(self.load_image_array, [path], tf.float32)
+        img.set_shape((*self.shape, self.channels))
+        if self.preprocessing_function is not None:
+            img = self.preprocessing_function(img)
+        return img
+
+    def load_image_array(self, path):
+        # decode and resize with PIL exactly like flow_from_directory() does,
+        # so that training and validation images match test and finetuning images
+        # (tf.io differs in grayscale conversion, jpeg decoding and resizing)
+        img = load_img(
+            path.decode("utf-8"),
+            color_mode=self.color_mode,
+            target_size=self.shape,
+            interpolation="nearest",
+        )
+        return img_to_array(img, data_format="channels_last", dtype="float32")
+
     def get_total_number_test_images(self):
         total_number = 0
         sub_dir_names = os.listdir(self.test_data_dir)
@@ -143,6 +296,25 @@ class Preprocessor:
         return total_number
 
 
+def list_class_filenames(directory):
+    """
+    Returns a list of (class_name, sorted image filenames) pairs,
+    one per class subdirectory of directory, sorted by class name.
+    """
+    class_filenames = []
+    for class_name in sorted(os.listdir(directory)):
+        class_dir = os.path.join(directory, class_name)
+        if not os.path.isdir(class_dir):
+            continue
+        filenames = sorted(
+            fname
+            for fname in os.listdir(class_dir)
+            if fname.lower().endswith(WHITE_LIST_FORMATS)
+        )
+        class_filenames.append((class_name, filenames))
+    return class_filenames
+
+
 def get_preprocessing_function(architecture):
     if architecture in ["mvtecCAE", "baselineCAE", "indexptionCAE", "resnetCAE"]:
         preprocessing_function = None
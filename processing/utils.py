@@ -76,6 +76,25 @@ def save_np(arr, save_dir, filename):
     )
 
 
+def predict_images(model, imgs, batch_size):
+    """
+    Reconstructs images in chunks of batch_size with a single traced graph,
+    instead of feeding the whole array to model.predict at once.
+    """
+
+    @tf.function(
+        input_signature=[tf.TensorSpec(shape=model.input_shape, dtype=tf.float32)]
+    )
+    def infer(x):
+        return model(x, training=False)
+
+    preds = [
+        infer(tf.convert_to_tensor(imgs[i : i + batch_size], dtype=tf.float32))
+        for i in range(0, len(imgs), batch_size)
+    ]
+    return tf.concat(preds, axis=0).numpy()
+
+
 def printProgressBar(
     iteration,
     total,
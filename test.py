@@ -4,6 +4,7 @@ import argparse
 from pathlib import Path
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 from processing import utils
 from processing import postprocessing
@@ -53,11 +54,14 @@ def save_segmented_images(resmaps, threshold, filenames, save_dir):
     seg_dir = os.path.join(save_dir, "segmentation")
     if not os.path.isdir(seg_dir):
         os.makedirs(seg_dir)
-    # save segmented resmaps
-    for i, resmap_th in enumerate(resmaps_th):
-        fname = utils.generate_new_name(filenames[i], suffix="seg")
+    # save segmented resmaps, png encoding releases the GIL so threads scale
+    def save_segmented_image(resmap_th, filename):
+        fname = utils.generate_new_name(filename, suffix="seg")
         fpath = os.path.join(seg_dir, fname)
         plt.imsave(fpath, resmap_th, cmap="gray")
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(save_segmented_image, resmaps_th, filenames))
     return
 
 
@@ -80,6 +84,7 @@ def main(args):
     vmin = info["preprocessing"]["vmin"]
     vmax = info["preprocessing"]["vmax"]
     nb_validation_images = info["data"]["nb_validation_images"]
+    batch_size = info["training"]["batch_size"]
 
     # =================== LOAD VALIDATION PARAMETERS =========================
 
@@ -141,7 +146,7 @@ def main(args):
         filenames = test_generator.filenames
 
         # predict on test images
-        imgs_test_pred = model.predict(imgs_test_input)
+        imgs_test_pred = utils.predict_images(model, imgs_test_input, batch_size)
 
         # instantiate TensorImages object
         tensor_test = postprocessing.TensorImages(
@@ -13,6 +13,7 @@ from processing.preprocessing import Preprocessor
 from processing.utils import printProgressBar as printProgressBar
 from processing import utils
 from processing import postprocessing
+import config
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -59,10 +60,21 @@ def main(args):
     # check arguments
     check_arguments(architecture, color_mode, loss)
 
+    # use float16 computations on GPU (must be set before building the model)
+    if config.MIXED_PRECISION and tf.config.list_physical_devices("GPU"):
+        keras.mixed_precision.set_global_policy("mixed_float16")
+        logger.info("mixed precision training enabled...")
+
+    # let XLA fuse the ops it supports; compile(jit_compile=True) is not an option
+    # since augmentation and upsampling gradients have no XLA kernels
+    if config.XLA:
+        tf.config.optimizer.set_jit("autoclustering")
+
     # get autoencoder
     autoencoder = AutoEncoder(input_dir, architecture, color_mode, loss, batch_size)
 
-    # load data as generators that yield batches of preprocessed images
+    # load data as tf.data pipelines that yield batches of preprocessed images,
+    # rescaling is left to the trainer on the device
     preprocessor = Preprocessor(
         input_directory=input_dir,
         rescale=autoencoder.rescale,
@@ -70,15 +82,20 @@ def main(args):
         color_mode=autoencoder.color_mode,
         preprocessing_function=autoencoder.preprocessing_function,
     )
-    train_generator = preprocessor.get_train_generator(
-        batch_size=autoencoder.batch_size, shuffle=True
+    train_dataset = preprocessor.get_train_dataset(
+        batch_size=autoencoder.batch_size, shuffle=True, rescale=False
     )
-    validation_generator = preprocessor.get_val_generator(
-        batch_size=autoencoder.batch_size, shuffle=True
+    validation_dataset = preprocessor.get_val_dataset(
+        batch_size=autoencoder.batch_size, shuffle=True, rescale=False
     )
 
     # find best learning rates for training
-    autoencoder.find_lr_opt(train_generator, validation_generator)
+    autoencoder.find_lr_opt(
+        train_dataset,
+        validation_dataset,
+        nb_train_images=preprocessor.nb_train_images,
+        nb_val_images=preprocessor.nb_val_images,
+    )
 
     # train
     autoencoder.fit(lr_opt=autoencoder.lr_opt)
@@ -95,16 +112,18 @@ def main(args):
         if not os.path.isdir(inspection_val_dir):
             os.makedirs(inspection_val_dir)
 
-        inspection_val_generator = preprocessor.get_val_generator(
-            batch_size=autoencoder.learner.val_data.samples, shuffle=False
+        inspection_val_dataset = preprocessor.get_val_dataset(
+            batch_size=preprocessor.nb_val_images, shuffle=False
         )
 
-        imgs_val_input = inspection_val_generator.next()[0]
-        filenames_val = inspection_val_generator.filenames
+        imgs_val_input = next(iter(inspection_val_dataset))[0].numpy()
+        filenames_val = preprocessor.get_filenames(subset="validation")
 
         # get reconstructed images (i.e predictions) on validation dataset
         logger.info("reconstructing validation images...")
-        imgs_val_pred = autoencoder.model.predict(imgs_val_input)
+        imgs_val_pred = utils.predict_images(
+            autoencoder.model, imgs_val_input, autoencoder.batch_size
+        )
 
         # instantiate TensorImages object to compute validation resmaps
         tensor_val = postprocessing.TensorImages(
@@ -141,7 +160,9 @@ def main(args):
 
         # get reconstructed images (i.e predictions) on validation dataset
         logger.info("reconstructing test images...")
-        imgs_test_pred = autoencoder.model.predict(imgs_test_input)
+        imgs_test_pred = utils.predict_images(
+            autoencoder.model, imgs_test_input, autoencoder.batch_size
+        )
 
         # instantiate TensorImages object to compute test resmaps
         tensor_test = postprocessing.TensorImages(
@@ -218,7 +239,7 @@ if __name__ == "__main__":
         required=False,
         metavar="",
         default=8,
-        help="batch size to use for training",
+        help="batch size per device to use for training",
     )
 
     parser.add_argument(